@@ -5,18 +5,33 @@ media based on various criteria such as type, status, country of origin, and gen
 is then written to CSV files for each category.
 
 Classes:
-    Media(TypedDict): A type definition for media items including attributes like id, title, and
+    Media(NamedTuple): A type definition for media items including attributes like id, title, and
         rank.
+    GraphQLRequestError(Exception): Raised when a request to the GraphQL API fails.
 
 Functions:
+    build_variables(categories: dict[str, dict[str, str]]) -> dict:
+        Builds the GraphQL variables holding the filters and sort criteria of each category.
+    build_alias(index: int) -> str:
+        Builds the GraphQL alias of a category from its position in the batched query.
+    build_batch_query(category_count: int) -> str:
+        Builds the GraphQL query string fetching every page of a batch of categories.
+    get_cache_path(url: str, json_data: dict) -> Path:
+        Gets the on-disk cache file path for a GraphQL request.
+    read_cache(cache_path: Path) -> None | tuple[dict, float]:
+        Reads a cached GraphQL response, if one exists.
+    write_cache(cache_path: Path, data: dict, response: requests.Response) -> None:
+        Writes a GraphQL response and its validator headers to the on-disk cache.
+    get_error_messages(data: object) -> None | str:
+        Joins the messages of the GraphQL errors in a response.
     post_graphql_request(url: str, json_data: dict) -> dict:
         Sends a POST request to the specified GraphQL API URL with provided JSON data.
-    get_top_media(
-        media_type: str, media_status: None | str, country: None | str, genre: None | str
-    )-> dict[int, Media]):
-        Fetches and ranks top media from AniList API based on the specified media type, status,
-        country of origin, or genre.
-    new_csv(rankings: dict[str, Media]) -> None:
+    get_top_media(categories: dict[str, dict[str, str]]) -> dict[str, list[Media]]:
+        Fetches and ranks top media from AniList API for each category, based on the specified media
+        type, status, country of origin, or genre, batching the categories into one query.
+    write_csv(csv_path: Path, media_list: list[Media]) -> None:
+        Writes the ranked media data of a single category into its CSV file.
+    new_csv(rankings: dict[str, list[Media]]) -> None:
         Writes the ranked media data into CSV files, one for each category in the rankings
         dictionary.
     main() -> None:
@@ -31,21 +46,93 @@ Usage:
     Run the script to fetch media data from AniList and write the ranked lists to CSV files in the
     current directory.
 """
+import atexit
 import csv
+import hashlib
+import math
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import chain
 from pathlib import Path
-from typing import TypedDict
+from typing import NamedTuple
 
+import orjson
 import requests
-from requests.exceptions import ConnectionError, HTTPError
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, HTTPError, RequestException, RetryError
+from urllib3.util.retry import Retry
 
 BASE_API_URL = "https://graphql.anilist.co"
 POPULARITY_SORT = "POPULARITY_DESC"
 SCORE_SORT = "SCORE_DESC"
-
-
-class Media(TypedDict):
+TOP_N = 100
+PER_PAGE = 50
+PAGES = range(1, math.ceil(TOP_N / PER_PAGE) + 1)
+CATEGORIES_PER_REQUEST = 3
+PAGE_QUERY = """
+      {alias}{page}: Page(page: {page}, perPage: $perPage) {{
+        pageInfo {{
+          hasNextPage
+        }}
+        media({arguments}) {{
+          id
+          title {{
+            romaji
+          }}
+        }}
+      }}"""
+CATEGORIES = {
+    "All Anime": {"media_type": "ANIME"},
+    "All Manga": {"media_type": "MANGA"},
+    "Releasing Anime": {"media_type": "ANIME", "media_status": "RELEASING"},
+    "Unreleased Anime": {"media_type": "ANIME", "media_status": "NOT_YET_RELEASED"},
+    "Releasing Manga": {"media_type": "MANGA", "media_status": "RELEASING"},
+    "Unreleased Manga": {"media_type": "MANGA", "media_status": "NOT_YET_RELEASED"},
+    "All Manhwa": {"media_type": "MANGA", "country": "KR"},
+    "All Hentai": {"media_type": "ANIME", "genre": "hentai"},
+    "All Hentai Manga": {"media_type": "MANGA", "genre": "hentai"},
+}
+MEDIA_ARGUMENTS = {
+    "type": "MediaType",
+    "status": "MediaStatus",
+    "countryOfOrigin": "CountryCode",
+    "genre": "String",
+    "sort": "[MediaSort]",
+}
+OUT_DIR = Path()
+CACHE_DIR = Path.home() / ".cache" / "al_ranked"
+CACHE_TTL = int(os.environ.get("AL_RANKED_CACHE_TTL", 3600))
+
+SESSION = requests.Session()
+SESSION.headers.update({"User-Agent": "AL-Ranked", "Content-Type": "application/json"})
+SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=10,
+        max_retries=Retry(
+            total=5,
+            backoff_factor=1.0,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods={"POST"},
+            respect_retry_after_header=True,
+        ),
+    ),
+)
+atexit.register(SESSION.close)
+
+
+class GraphQLRequestError(Exception):
+    """Raised when a GraphQL request fails, or the API responds with GraphQL errors."""
+
+
+class Media(NamedTuple):
     """Represents a media item.
 
+    Stored as a tuple, so a list of media items can be written to CSV rows directly.
+
     Fields:
     - id: An integer field that represents the unique identifier of the media item.
     - title: A string field that represents the title of the media item.
@@ -57,55 +144,172 @@ class Media(TypedDict):
     rank: int
 
 
-def build_query(
-    media_type: str,
-    sort_criteria: str,
-    media_status: None | str = None,
-    country: None | str = None,
-    genre: None | str = None,
-) -> str:
-    """Builds the GraphQL query string based on the provided parameters.
+def build_variables(categories: dict[str, dict[str, str]]) -> dict:
+    """Builds the GraphQL variables holding the filters and sort criteria of every category.
+
+    Args:
+        categories (dict): A dictionary where the keys are the rankings categories and the values
+            are the filters (media_type, and optionally media_status, country and genre).
+
+    Returns:
+        dict: The variables for the batched query. Filters that are not set are omitted, which the
+            API treats the same as not filtering on them.
+    """
+    variables = {"perPage": PER_PAGE}
+    for index, filters in enumerate(categories.values()):
+        media_status = filters.get("media_status")
+        query_parts = {
+            "type": filters["media_type"],
+            "status": media_status,
+            "countryOfOrigin": filters.get("country"),
+            "genre": filters.get("genre"),
+            "sort": POPULARITY_SORT if media_status == "NOT_YET_RELEASED" else SCORE_SORT,
+        }
+        query_filters = ", ".join(
+            [f"{key}: {value}" for key, value in query_parts.items() if value is not None],
+        )
+        print(f"Generating request for the following filter - {query_filters}")
+        alias = build_alias(index)
+        variables.update(
+            {f"{key}_{alias}": value for key, value in query_parts.items() if value is not None},
+        )
+    return variables
+
+
+def build_alias(index: int) -> str:
+    """Builds the GraphQL alias of a category from its position in the batched query.
+
+    Aliases are positional rather than derived from the category name, so any name can be used for
+    a category without producing an invalid or duplicate GraphQL name.
+
+    Args:
+        index (int): The position of the category in the batched query.
+
+    Returns:
+        str: The alias of the category, e.g. 'c0'.
+    """
+    return f"c{index}"
+
+
+@lru_cache(maxsize=4)
+def build_batch_query(category_count: int) -> str:
+    """Builds a single GraphQL query string that fetches every page of a batch of categories.
+
+    Each page of each category is selected as its own aliased 'Page' field, so the API resolves all
+    of them in one request over a single connection. The filters and sort criteria of a category
+    are referenced as GraphQL variables suffixed with its alias, see 'build_variables'.
 
     Args:
-        media_type (str): The type of media for the query.
-        sort_criteria (str): The sorting criteria for the query.
-        media_status (None | str): The status of the media.
-        country (None | str): The country of origin of the media.
-        genre (None | str): The genre of the media.
+        category_count (int): The number of categories in the batched query.
 
     Returns:
         str: The constructed GraphQL query string.
     """
-    query_parts = {
-        "type": media_type,
-        "status": media_status,
-        "countryOfOrigin": country,
-        "genre": f'"{genre}"' if genre else None,
-    }
-    query_filters = ", ".join(
-        [f"{key}: {value}" for key, value in query_parts.items() if value is not None],
-    )
-    print(f"Generating request for the following filter - {query_filters}")
+    declarations = ["$perPage: Int"]
+    pages = []
+    for index in range(category_count):
+        alias = build_alias(index)
+        declarations.extend(
+            f"${argument}_{alias}: {variable_type}"
+            for argument, variable_type in MEDIA_ARGUMENTS.items()
+        )
+        arguments = ", ".join(f"{argument}: ${argument}_{alias}" for argument in MEDIA_ARGUMENTS)
+        pages.extend(
+            PAGE_QUERY.format(alias=alias, page=page, arguments=arguments) for page in PAGES
+        )
     return f"""
-    query ($page: Int, $perPage: Int) {{
-      Page(page: $page, perPage: $perPage) {{
-        media({query_filters}, sort: {sort_criteria}) {{
-          id
-          title {{
-            romaji
-          }}
-          averageScore
-        }}
-      }}
+    query ({", ".join(declarations)}) {{{"".join(pages)}
     }}
     """
 
 
+def get_cache_path(url: str, json_data: dict) -> Path:
+    """Gets the path of the cache file for a GraphQL request.
+
+    Args:
+        url (str): The URL to which the GraphQL request is sent.
+        json_data (dict): The JSON data included in the request body.
+
+    Returns:
+        Path: The cache file path, named after a hash of the URL and request body.
+    """
+    request_key = orjson.dumps({"url": url, "body": json_data}, option=orjson.OPT_SORT_KEYS)
+    return CACHE_DIR / f"{hashlib.blake2b(request_key, digest_size=16).hexdigest()}.json"
+
+
+def read_cache(cache_path: Path) -> None | tuple[dict, float]:
+    """Reads a cached GraphQL response.
+
+    Args:
+        cache_path (Path): The path of the cache file.
+
+    Returns:
+        None | tuple[dict, float]: The cache entry containing the response data and its 'ETag' and
+            'Last-Modified' headers, along with the modification time of the cache file, or None if
+            there is no usable cache entry.
+    """
+    try:
+        with cache_path.open("rb") as cache_file:
+            modified = os.fstat(cache_file.fileno()).st_mtime
+            cache_entry = orjson.loads(cache_file.read())
+    except (OSError, orjson.JSONDecodeError):
+        return None
+    if not isinstance(cache_entry, dict) or not isinstance(cache_entry.get("data"), dict):
+        return None
+    return cache_entry, modified
+
+
+def write_cache(cache_path: Path, data: dict, response: requests.Response) -> None:
+    """Writes a GraphQL response to the cache, along with the headers for conditional requests.
+
+    Args:
+        cache_path (Path): The path of the cache file.
+        data (dict): The response from the GraphQL request as a dictionary.
+        response (requests.Response): The response the data was parsed from.
+    """
+    cache_entry = {
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+        "data": data,
+    }
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        cache_path.write_bytes(orjson.dumps(cache_entry))
+    except OSError as error:
+        print(f"Unable to write cache file {cache_path}: {error}")
+
+
+def get_error_messages(data: object) -> None | str:
+    """Joins the messages of the GraphQL errors in a response.
+
+    Args:
+        data (object): The decoded body of the response.
+
+    Returns:
+        None | str: The messages of the GraphQL errors, or None if the body has no errors.
+    """
+    if not isinstance(data, dict) or not isinstance(data.get("errors"), list):
+        return None
+    return "; ".join(
+        error.get("message", str(error)) if isinstance(error, dict) else str(error)
+        for error in data["errors"]
+    )
+
+
 def post_graphql_request(url: str, json_data: dict) -> dict:
     """Sends a GraphQL request to a specified URL.
 
     Sends a GraphQL request to a specified URL with the given JSON data and returns the response as
-    a dictionary.
+    a dictionary. Requests go through the shared session so the connection to the API is kept alive
+    and reused between calls.
+
+    Transient errors and rate limiting are retried with backoff by the session, waiting for as long
+    as the API's 'Retry-After' header asks when it is rate limited.
+
+    Responses are cached on disk for CACHE_TTL seconds, which can be set with the
+    'AL_RANKED_CACHE_TTL' environment variable (0 always revalidates with the API). Once a cache
+    entry expires, the request is made conditional on its 'ETag' or 'Last-Modified' header, and the
+    cached data is reused if the API reports it as not modified.
 
     Args:
         url (str): The URL to which the GraphQL request will be sent.
@@ -113,97 +317,173 @@ def post_graphql_request(url: str, json_data: dict) -> dict:
 
     Returns:
         dict: The response from the GraphQL request as a dictionary.
+
+    Raises:
+        GraphQLRequestError: If the request fails once retries are exhausted, the response is not
+            valid JSON, or the response contains GraphQL errors. The messages of any GraphQL errors
+            are included, including those the API sends with a 4xx status.
     """
+    cache_path = get_cache_path(url, json_data)
+    cached = read_cache(cache_path)
+    cache_entry = None
+    headers = {}
+    if cached:
+        cache_entry, modified = cached
+        if time.time() - modified < CACHE_TTL:
+            return cache_entry["data"]
+        if cache_entry.get("etag"):
+            headers["If-None-Match"] = cache_entry["etag"]
+        if cache_entry.get("last_modified"):
+            headers["If-Modified-Since"] = cache_entry["last_modified"]
     try:
-        response = requests.post(url, json=json_data, timeout=10)
+        response = SESSION.post(url, data=orjson.dumps(json_data), headers=headers, timeout=10)
         response.raise_for_status()
-        return response.json()
+        if response.status_code != 304:
+            data = orjson.loads(response.content)
     except HTTPError as error:
-        print(f"Error: {error}")
-        if hasattr(error.response, "request") and error.response.request:
-            print(f"Request Headers: {error.response.request.headers}")
+        try:
+            messages = get_error_messages(orjson.loads(error.response.content))
+        except orjson.JSONDecodeError:
+            messages = None
+        if messages:
+            raise GraphQLRequestError(
+                f"Error in GraphQL response ({error.response.status_code}): {messages}",
+            ) from error
+        raise GraphQLRequestError(f"Error: {error}") from error
+    except RetryError as error:
+        raise GraphQLRequestError(f"Error after retrying request: {error}") from error
     except ConnectionError as error:
-        print(f"Error connecting to API: {error}")
+        raise GraphQLRequestError(f"Error connecting to API: {error}") from error
+    except RequestException as error:
+        raise GraphQLRequestError(f"Error requesting API: {error}") from error
+    except orjson.JSONDecodeError as error:
+        raise GraphQLRequestError(f"Invalid JSON in API response: {error}") from error
+    if response.status_code == 304:
+        try:
+            cache_path.touch()
+        except OSError as error:
+            print(f"Unable to refresh cache file {cache_path}: {error}")
+        return cache_entry["data"]
+    if not isinstance(data, dict):
+        raise GraphQLRequestError("Unexpected API response, expected a JSON object")
+    if "errors" in data:
+        raise GraphQLRequestError(f"Error in GraphQL response: {get_error_messages(data)}")
+    write_cache(cache_path, data, response)
+    return data
+
 
+def get_top_media(categories: dict[str, dict[str, str]]) -> dict[str, list[Media]]:
+    """Retrieves and ranks media for a batch of categories in a single batched query.
 
-def get_top_media(
-    media_type: str,
-    media_status: None | str = None,
-    country: None | str = None,
-    genre: None | str = None,
-) -> dict[int, Media]:
-    """Retrieves and ranks media based on various criteria such as media type, status, etc.
+    Up to TOP_N media are ranked per category, stopping early when the API reports that a category
+    has no further pages.
 
     Args:
-        media_type (str): The type of media to retrieve and rank.
-        media_status (None | str): The status of the media. Defaults to None.
-        country (None | str): The country of origin of the media. Defaults to None.
-        genre (None | str): The genre of the media. Defaults to None.
+        categories (dict): A dictionary where the keys are the rankings categories and the values
+            are the filters (media_type, and optionally media_status, country and genre).
 
     Returns:
-        dict[int, Media]: A dictionary containing the ranked media items, where the keys are the
-            media IDs and the values are dictionaries containing the media ID, title, and rank.
+        dict[str, list[Media]]: A dictionary where the keys are the rankings categories and the
+            values are lists of the ranked media items, in rank order.
+
+    Raises:
+        GraphQLRequestError: If the batched request to the API fails.
     """
-    variables = {"perPage": 50}
-    ranked_media = {}
-    sort_criteria = POPULARITY_SORT if media_status == "NOT_YET_RELEASED" else SCORE_SORT
-    query = build_query(media_type, sort_criteria, media_status, country, genre)
-    for page in [1, 2]:
-        variables["page"] = page
-        json_data = {"query": query, "variables": variables}
-        data = post_graphql_request(BASE_API_URL, json_data)
-        for item in data["data"]["Page"]["media"]:
-            ranked_media[item["id"]] = {
-                "id": item["id"],
-                "title": item["title"]["romaji"],
-                "rank": len(ranked_media) + 1,
-            }
-    return ranked_media
-
-
-def new_csv(rankings: dict[str, dict[int, Media]]) -> None:
+    rankings = {}
+    json_data = {
+        "query": build_batch_query(len(categories)),
+        "variables": build_variables(categories),
+    }
+    data = post_graphql_request(BASE_API_URL, json_data)
+    for index, rank_type in enumerate(categories):
+        alias = build_alias(index)
+        pages = []
+        for page in PAGES:
+            page_data = data["data"][f"{alias}{page}"]
+            pages.append(page_data["media"])
+            if not page_data["pageInfo"]["hasNextPage"]:
+                break
+        # The API returns media in sort order, so the rank is its position across the pages.
+        rankings[rank_type] = [
+            Media(item["id"], item["title"]["romaji"], rank)
+            for rank, item in zip(range(1, TOP_N + 1), chain.from_iterable(pages))
+        ]
+    return rankings
+
+
+def write_csv(csv_path: Path, media_list: list[Media]) -> None:
+    """Write the rankings of a single category to a CSV file.
+
+    The rows are written to a temporary file which then replaces the CSV file, so a partially
+    written CSV file is never left behind.
+
+    Args:
+        csv_path (Path): The path of the CSV file of the category.
+        media_list (list[Media]): The ranked media items of the category.
+    """
+    tmp_path = csv_path.with_suffix(".csv.tmp")
+    try:
+        with tmp_path.open("w", buffering=1 << 20, newline="", encoding="utf-8") as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(Media._fields)
+            writer.writerows(media_list)
+        os.replace(tmp_path, csv_path)
+    except OSError as error:
+        tmp_path.unlink(missing_ok=True)
+        if not isinstance(error, PermissionError):
+            raise
+        print(f"Lack of permissions to open {csv_path}. Check if file is still open: {error}")
+
+
+def new_csv(rankings: dict[str, list[Media]]) -> None:
     """Create a CSV file with the rankings data.
 
+    The CSV files are written concurrently to OUT_DIR, one per category.
+
     Args:
         rankings (dict): A dictionary containing the rankings data. The keys represent the different
             rankings categories, and the values are the results of the 'get_top_media' function.
     """
-    for rank_type, media_list in rankings.items():
-        csv_name = f"{rank_type}.csv"
-        try:
-            with Path(csv_name).open("w", newline="", encoding="utf-8") as csvfile:
-                fieldnames = ["id", "title", "rank"]
-                writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-                writer.writeheader()
-                writer.writerows(media_list.values())
-        except PermissionError as error:
-            print(f"Lack of permissions to open {csvfile}. Check if file is still open: {error}")
+    OUT_DIR.mkdir(parents=True, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        futures = [
+            executor.submit(write_csv, OUT_DIR / f"{rank_type}.csv", media_list)
+            for rank_type, media_list in rankings.items()
+        ]
+        for future in futures:
+            future.result()
 
 
 def main() -> None:
     """Orchestrates the fetching, ranking, and CSV export of media data from the AniList API.
 
     This function serves as the entry point for the script. It calls the 'get_top_media' function
-    with different parameters to fetch various categories of media, including anime and manga, based
-    on type, status, country of origin, and genre. The retrieved media data is then ranked and
+    with the filters in CATEGORIES for various categories of media, including anime and manga,
+    based on type, status, country of origin, and genre. The retrieved media data is then ranked and
     stored in a dictionary. Finally, it calls 'new_csv' to export these rankings into separate CSV
     files for each category.
 
+    The categories are fetched CATEGORIES_PER_REQUEST at a time to keep each query small, as the
+    API limits query complexity. A batch that fails is reported and skipped, so the rankings of the
+    other categories are still exported.
+
     Usage:
         Called when the script is executed directly. It requires no arguments and returns nothing.
         Generates CSV files in the current directory with ranked media data.
     """
-    rankings = {
-        "All Anime": get_top_media(media_type="ANIME"),
-        "All Manga": get_top_media(media_type="MANGA"),
-        "Releasing Anime": get_top_media(media_type="ANIME", media_status="RELEASING"),
-        "Unreleased Anime": get_top_media(media_type="ANIME", media_status="NOT_YET_RELEASED"),
-        "Releasing Manga": get_top_media(media_type="MANGA", media_status="RELEASING"),
-        "Unreleased Manga": get_top_media(media_type="MANGA", media_status="NOT_YET_RELEASED"),
-        "All Manhwa": get_top_media(media_type="MANGA", country="KR"),
-        "All Hentai": get_top_media(media_type="ANIME", genre="hentai"),
-        "All Hentai Manga": get_top_media(media_type="MANGA", genre="hentai"),
-    }
+    rankings = {}
+    rank_types = list(CATEGORIES)
+    for start in range(0, len(rank_types), CATEGORIES_PER_REQUEST):
+        batch = {
+            rank_type: CATEGORIES[rank_type]
+            for rank_type in rank_types[start : start + CATEGORIES_PER_REQUEST]
+        }
+        try:
+            rankings.update(get_top_media(batch))
+        except GraphQLRequestError as error:
+            print(f"Unable to fetch rankings for {', '.join(batch)} from AniList. {error}")
+    if not rankings:
+        raise SystemExit("Unable to fetch any rankings from AniList.")
     new_csv(rankings)
 
 